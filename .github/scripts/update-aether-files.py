@@ -6,13 +6,18 @@
 # and configures sd-core values to use local registry image for testing
 
 import argparse
+import fcntl
+import hashlib
+import os
 import re
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
 import shutil
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple
 
 try:
     import yaml
@@ -20,36 +25,52 @@ except ImportError:
     print("ERROR: PyYAML is required. Install with: sudo apt install python3-yaml", file=sys.stderr)
     sys.exit(1)
 
+# Prefer the LibYAML bindings when available; they are much faster than the pure-Python implementation.
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 
-def run_command(cmd: list, check: bool = True, capture: bool = True) -> subprocess.CompletedProcess:
-    """Run a shell command and return the result."""
-    if capture:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=check)
-    else:
-        result = subprocess.run(cmd, check=check)
-    return result
+_PROC_NET_ROUTE = '/proc/net/route'
+_RTF_UP = 0x1
+_SIOCGIFADDR = 0x8915
+
+_TEMPLATE_RE = re.compile(r'\{\{[^}]+\}\}')
+
+# When set, pulled charts are cached here so repeated runs skip the download
+_CHART_CACHE_ENV = 'AETHER_CHART_CACHE'
+
+
+def run_command(cmd: list, check: bool = True, stdout: Optional[int] = None) -> subprocess.CompletedProcess:
+    """Run a shell command and return the result, optionally redirecting its stdout."""
+    return subprocess.run(cmd, stdout=stdout, text=True, check=check)
 
 
 def get_network_info() -> Tuple[str, str]:
     """Detect the default network interface and IP address."""
     try:
-        # Get default interface
-        result = run_command(['ip', 'route'])
-        for line in result.stdout.splitlines():
-            if 'default' in line:
-                parts = line.split()
-                interface = parts[parts.index('dev') + 1]
-                break
-        else:
-            raise RuntimeError("Could not find default network interface")
+        # Get default interface from the kernel routing table
+        with open(_PROC_NET_ROUTE, 'r') as f:
+            next(f)  # Skip header
+            for line in f:
+                fields = line.split()
+                if len(fields) < 8:
+                    continue
+                # Only a 0.0.0.0/0 route is the default; skip split routes such as 0.0.0.0/1
+                if fields[1] == '00000000' and fields[7] == '00000000' and int(fields[3], 16) & _RTF_UP:
+                    interface = fields[0]
+                    break
+            else:
+                raise RuntimeError("Could not find default network interface")
 
         # Get IP address for that interface
-        result = run_command(['ip', '-4', 'addr', 'show', interface])
-        ip_match = re.search(r'inet\s+(\d+\.\d+\.\d+\.\d+)', result.stdout)
-        if not ip_match:
-            raise RuntimeError(f"Could not find IP address for interface {interface}")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                ifreq = fcntl.ioctl(sock.fileno(), _SIOCGIFADDR, struct.pack('256s', interface[:15].encode()))
+            except OSError:
+                raise RuntimeError(f"Could not find IP address for interface {interface}")
 
-        ip_addr = ip_match.group(1)
+        ip_addr = socket.inet_ntoa(ifreq[20:24])
         return interface, ip_addr
 
     except Exception as e:
@@ -60,8 +81,6 @@ def get_network_info() -> Tuple[str, str]:
 def update_hosts_ini(aether_dir: Path) -> None:
     """Generate a localhost-only hosts.ini for CI, avoiding SSH transport."""
     hosts_file = aether_dir / 'hosts.ini'
-
-    import os
     ansible_user = os.environ.get('USER', 'runner')
 
     content = (
@@ -79,7 +98,7 @@ def update_hosts_ini(aether_dir: Path) -> None:
         "localhost\n"
     )
 
-    hosts_file.write_text(content)
+    hosts_file.write_bytes(content.encode('utf-8'))
     print(f"Generated local-only {hosts_file} for user: {ansible_user}")
 
 
@@ -104,8 +123,7 @@ def update_nested_keys(data: object, key_name: str, value: str) -> int:
 def update_vars_main(aether_dir: Path, interface: str, ip_addr: str, gnbsim_image: Optional[str] = None) -> None:
     """Update vars/main.yml with detected interface, IP, and optionally gnbsim image."""
     vars_file = aether_dir / 'vars' / 'main.yml'
-    with open(vars_file, 'r') as f:
-        vars_data = yaml.safe_load(f) or {}
+    vars_data = yaml.load(vars_file.read_bytes(), Loader=SafeLoader) or {}
 
     interface_updates = update_nested_keys(vars_data, 'data_iface', interface)
     if interface_updates == 0:
@@ -139,15 +157,18 @@ def update_vars_main(aether_dir: Path, interface: str, ip_addr: str, gnbsim_imag
         container_config['image'] = gnbsim_image
         print(f"Updated gnbsim image to {gnbsim_image}")
 
-    with open(vars_file, 'w') as f:
-        yaml.dump(vars_data, f, default_flow_style=False, sort_keys=False)
+    rendered = yaml.dump(vars_data, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
+    vars_file.write_bytes(rendered.encode('utf-8'))
 
     print(f"Updated {vars_file}")
 
 
 def replace_aether_templates_with_placeholders(content: str) -> str:
     """Replace Aether template expressions and control lines with YAML-safe placeholders."""
-    expression_pattern = re.compile(r'\{\{[^}]+\}\}')
+    # Plain YAML needs no placeholders
+    if '{{' not in content and '{%' not in content:
+        return content
+
     placeholder_index = 0
 
     def line_indent(line: str) -> str:
@@ -159,13 +180,6 @@ def replace_aether_templates_with_placeholders(content: str) -> str:
         placeholder_index += 1
         return f'{indent}{placeholder}: "{placeholder}"'
 
-    def replace_expression(match: re.Match[str]) -> str:
-        nonlocal placeholder_index
-        placeholder = f"AETHER_EXPR_PLACEHOLDER_{placeholder_index}"
-        placeholder_index += 1
-        # Quote the placeholder so YAML parsers treat it as a string.
-        return f'"{placeholder}"'
-
     processed_lines = []
     original_lines = content.splitlines()
 
@@ -192,16 +206,24 @@ def replace_aether_templates_with_placeholders(content: str) -> str:
         processed_lines.append(line)
 
     modified_content = '\n'.join(processed_lines)
-    modified_content = expression_pattern.sub(replace_expression, modified_content)
-    return modified_content
+
+    segments = []
+    last_end = 0
+    for match in _TEMPLATE_RE.finditer(modified_content):
+        segments.append(modified_content[last_end:match.start()])
+        # Quote the placeholder so YAML parsers treat it as a string.
+        segments.append(f'"AETHER_EXPR_PLACEHOLDER_{placeholder_index}"')
+        placeholder_index += 1
+        last_end = match.end()
+    segments.append(modified_content[last_end:])
+
+    return ''.join(segments)
 
 
 def get_chart_info(aether_dir: Path) -> Tuple[str, str]:
     """Extract Helm chart reference and version from vars/main.yml."""
     vars_file = aether_dir / 'vars' / 'main.yml'
-
-    with open(vars_file, 'r') as f:
-        vars_data = yaml.safe_load(f)
+    vars_data = yaml.load(vars_file.read_bytes(), Loader=SafeLoader)
 
     chart_ref = vars_data.get('core', {}).get('helm', {}).get('chart_ref')
     chart_version = vars_data.get('core', {}).get('helm', {}).get('chart_version')
@@ -214,10 +236,29 @@ def get_chart_info(aether_dir: Path) -> Tuple[str, str]:
     return chart_ref, chart_version
 
 
-def find_single_directory(base_dir: Path, name: str) -> Optional[Path]:
+def index_directories(base_dir: Path) -> dict:
+    """Map each directory name under base_dir to the paths where it occurs."""
+    dir_index = {}
+    pending = [str(base_dir)]
+
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+
+                dir_index.setdefault(entry.name, []).append(Path(entry.path))
+
+                # Do not descend into symlinked directories
+                if not entry.is_symlink():
+                    pending.append(entry.path)
+
+    return dir_index
+
+
+def find_single_directory(dir_index: dict, name: str) -> Optional[Path]:
     """Find a single directory with the given name, error if multiple or none found."""
-    matches = list(base_dir.rglob(name))
-    matches = [m for m in matches if m.is_dir()]
+    matches = dir_index.get(name, [])
 
     if len(matches) == 0:
         return None
@@ -230,11 +271,8 @@ def find_single_directory(base_dir: Path, name: str) -> Optional[Path]:
     return matches[0]
 
 
-def get_enabled_sections(base_values_file: Path) -> list:
-    """Extract enabled sections from sdcore-5g-values.yaml."""
-    with open(base_values_file, 'r') as f:
-        values = yaml.safe_load(f)
-
+def get_enabled_sections(values: Optional[dict]) -> list:
+    """Extract enabled sections from parsed sdcore-5g-values.yaml content."""
     enabled_sections = []
     if values:
         for section_name, section_config in values.items():
@@ -249,47 +287,54 @@ def get_enabled_sections(base_values_file: Path) -> list:
     return enabled_sections
 
 
-def build_image_overrides(
-    chart_dir: Path,
-    base_values_file: Path,
-    image_name: str,
-    local_image_name: str,
-    registry_prefix: str
-) -> dict:
-    """Build the image override structure for sd-core values based on enabled sections."""
-    overrides = {}
-
-    # Get enabled sections from the base values file
-    enabled_sections = get_enabled_sections(base_values_file)
+def iter_enabled_charts(chart_dir: Path, base_values: Optional[dict]) -> Iterator[Tuple[str, dict]]:
+    """Yield (section name, chart values) for each enabled section that has a chart values.yaml."""
+    # Get enabled sections from the base values
+    enabled_sections = get_enabled_sections(base_values)
 
     if not enabled_sections:
         print("WARNING: No enabled sections found in values file")
-        return overrides
+        return
+
+    # Walk the chart tree once and look up each section in the index
+    dir_index = index_directories(chart_dir)
 
     for section_name in enabled_sections:
         # Try to find corresponding chart directory
-        section_dir = find_single_directory(chart_dir, section_name)
+        section_dir = find_single_directory(dir_index, section_name)
 
         # Some charts might have different names, try common alternatives
         if not section_dir and section_name == 'omec-user-plane':
-            section_dir = find_single_directory(chart_dir, 'bess-upf')
+            section_dir = find_single_directory(dir_index, 'bess-upf')
 
         if not section_dir or not (section_dir / 'values.yaml').exists():
             continue
 
-        with open(section_dir / 'values.yaml', 'r') as f:
-            chart_values = yaml.safe_load(f)
+        chart_values = yaml.load((section_dir / 'values.yaml').read_bytes(), Loader=SafeLoader)
+        yield section_name, chart_values or {}
+
+
+def build_image_overrides(
+    chart_dir: Path,
+    base_values: Optional[dict],
+    image_name: str,
+    local_image_name: str,
+    registry_prefix: str
+) -> dict:
+    """Build the image override structure for sd-core values based on enabled sections."""
+    overrides = {}
 
+    for section_name, chart_values in iter_enabled_charts(chart_dir, base_values):
         # Check if this chart has images to override
-        if not chart_values.get('images', {}).get('tags'):
+        images = chart_values.get('images')
+        chart_tags = images.get('tags') if isinstance(images, dict) else None
+        if not chart_tags:
             continue
 
-        tags = {}
-        for tag_name, tag_value in chart_values.get('images', {}).get('tags', {}).items():
-            if tag_name == image_name:
-                tags[tag_name] = local_image_name
-            else:
-                tags[tag_name] = f"{registry_prefix}{tag_value}"
+        tags = {
+            tag_name: local_image_name if tag_name == image_name else f"{registry_prefix}{tag_value}"
+            for tag_name, tag_value in chart_tags.items()
+        }
 
         # Build override structure
         override_struct = {
@@ -308,6 +353,7 @@ def render_section_images_block(images_config: dict) -> list[str]:
     """Render an images block with the indentation expected in sd-core values."""
     rendered = yaml.dump(
         {'images': images_config},
+        Dumper=SafeDumper,
         default_flow_style=False,
         sort_keys=False,
     ).splitlines()
@@ -379,6 +425,60 @@ def apply_image_overrides_to_content(content: str, overrides: dict) -> str:
     return ''.join(lines)
 
 
+def find_sdcore_chart_dirs(directory: Path) -> list:
+    """List the untarred sd-core chart directories directly under directory."""
+    return [d for d in directory.iterdir() if d.is_dir() and d.name.startswith('sd-core')]
+
+
+def pull_helm_chart(chart_ref: str, chart_version: str, destination: Path) -> Path:
+    """Pull and untar a Helm chart into destination and return the sd-core chart directory."""
+    print(f"Pulling Helm chart...")
+    run_command(['helm', 'pull', chart_ref, '--version', chart_version, '--untar', '--destination', str(destination)],
+                check=True, stdout=subprocess.DEVNULL)
+
+    chart_dirs = find_sdcore_chart_dirs(destination)
+    if not chart_dirs:
+        print("ERROR: Could not find pulled chart directory", file=sys.stderr)
+        sys.exit(1)
+    if len(chart_dirs) > 1:
+        print(f"ERROR: Found multiple sd-core directories in {destination}: {[d.name for d in chart_dirs]}", file=sys.stderr)
+        sys.exit(1)
+
+    return chart_dirs[0]
+
+
+def pull_cached_helm_chart(chart_ref: str, chart_version: str, cache_root: Path) -> Path:
+    """Return the sd-core chart directory from cache_root, pulling the chart on a miss."""
+    chart_key = hashlib.sha256(chart_ref.encode('utf-8')).hexdigest()[:16]
+    chart_cache_dir = cache_root / f"{chart_key}-{chart_version}"
+
+    if chart_cache_dir.is_dir():
+        chart_dirs = find_sdcore_chart_dirs(chart_cache_dir)
+        if len(chart_dirs) == 1:
+            print(f"Using cached Helm chart: {chart_cache_dir}")
+            return chart_dirs[0]
+
+        print(f"WARNING: Discarding invalid Helm chart cache entry: {chart_cache_dir}")
+        shutil.rmtree(chart_cache_dir)
+
+    cache_root.mkdir(parents=True, exist_ok=True)
+
+    # Untar into a staging directory so an interrupted pull never leaves a partial cache entry
+    with tempfile.TemporaryDirectory(dir=cache_root) as staging_dir:
+        staged_chart_dir = Path(staging_dir) / 'chart'
+        staged_chart_dir.mkdir()
+        pulled_chart_dir = pull_helm_chart(chart_ref, chart_version, staged_chart_dir)
+        try:
+            os.rename(staged_chart_dir, chart_cache_dir)
+        except OSError:
+            # Another run filled the cache first; use its entry and drop the staged copy
+            if not chart_cache_dir.is_dir():
+                raise
+            print(f"Using Helm chart cached by a concurrent run: {chart_cache_dir}")
+
+    return chart_cache_dir / pulled_chart_dir.name
+
+
 def configure_sdcore_images(
     aether_dir: Path,
     image_name: str,
@@ -395,67 +495,54 @@ def configure_sdcore_images(
         sys.exit(1)
 
     # Read original content
-    original_content = base_values_file.read_text()
+    original_content = base_values_file.read_text(encoding='utf-8')
 
     # Replace Aether templates with placeholders so YAML parsing can inspect enabled sections.
     print("Replacing Aether templates with placeholders...")
     modified_content = replace_aether_templates_with_placeholders(original_content)
 
-    # Write modified content to temp file for YAML processing
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.yaml', delete=False) as temp_base:
-        temp_base.write(modified_content)
-        temp_base_path = Path(temp_base.name)
+    # Parse the placeholder version in memory to inspect enabled sections.
+    base_values = yaml.load(modified_content, Loader=SafeLoader)
+
+    # Get chart info and pull chart
+    chart_ref, chart_version = get_chart_info(aether_dir)
+    print(f"Chart: {chart_ref} version {chart_version}")
+
+    # Only cache charts in an explicitly configured directory; otherwise use a private temp directory
+    chart_cache_root = os.environ.get(_CHART_CACHE_ENV)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if chart_cache_root:
+            pulled_chart_dir = pull_cached_helm_chart(chart_ref, chart_version, Path(chart_cache_root))
+        else:
+            pulled_chart_dir = pull_helm_chart(chart_ref, chart_version, Path(temp_dir))
+
+        # Build image overrides
+        print("\n=== Extracting image tags from Helm chart values ===")
+        overrides = build_image_overrides(
+            pulled_chart_dir,
+            base_values,
+            image_name,
+            local_image_name,
+            registry_prefix
+        )
+
+    # Update only the images blocks so templated YAML structure is preserved.
+    final_content = apply_image_overrides_to_content(original_content, overrides)
 
+    # Write final content to a sibling file and swap it in so an interrupted run never leaves a truncated file
+    temp_values_file = base_values_file.with_suffix('.yaml.tmp')
     try:
-        # Get chart info and pull chart
-        chart_ref, chart_version = get_chart_info(aether_dir)
-        print(f"Chart: {chart_ref} version {chart_version}")
-
-        # Create temp directory for chart
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_chart_dir = Path(temp_dir)
-
-            # Pull the Helm chart into temp directory
-            print(f"Pulling Helm chart...")
-            run_command(['helm', 'pull', chart_ref, '--version', chart_version, '--untar', '--destination', str(temp_chart_dir)],
-                       check=True, capture=False)
-
-            # Find the pulled chart directory (should be in temp directory)
-            chart_dirs = [d for d in temp_chart_dir.iterdir() if d.is_dir() and d.name.startswith('sd-core')]
-            if not chart_dirs:
-                print("ERROR: Could not find pulled chart directory", file=sys.stderr)
-                sys.exit(1)
-            if len(chart_dirs) > 1:
-                print(f"ERROR: Found multiple sd-core directories in temp directory: {[d.name for d in chart_dirs]}", file=sys.stderr)
-                sys.exit(1)
-
-            pulled_chart_dir = chart_dirs[0]
-
-            # Build image overrides
-            print("\n=== Extracting image tags from Helm chart values ===")
-            overrides = build_image_overrides(
-                pulled_chart_dir,
-                temp_base_path,
-                image_name,
-                local_image_name,
-                registry_prefix
-            )
-
-            # Update only the images blocks so templated YAML structure is preserved.
-            final_content = apply_image_overrides_to_content(original_content, overrides)
-
-            # Write final content back to original file
-            base_values_file.write_text(final_content)
-
-            print(f"\n=== Image overrides merged into: {base_values_file} ===")
-            print(f"Local image ({image_name}): {local_image_name}")
-            print(f"Other images: {registry_prefix}<image from chart>")
-
-            # Clean up pulled chart
-            shutil.rmtree(pulled_chart_dir, ignore_errors=True)
-
-    finally:
-        temp_base_path.unlink(missing_ok=True)
+        temp_values_file.write_bytes(final_content.encode('utf-8'))
+        temp_values_file.chmod(base_values_file.stat().st_mode & 0o777)
+        os.replace(temp_values_file, base_values_file)
+    except BaseException:
+        temp_values_file.unlink(missing_ok=True)
+        raise
+
+    print(f"\n=== Image overrides merged into: {base_values_file} ===")
+    print(f"Local image ({image_name}): {local_image_name}")
+    print(f"Other images: {registry_prefix}<image from chart>")
 
 
 def main():